@@ -9,110 +9,157 @@
 # show_dir(batch, MODE)
 # It relies on functions in app_helper.py
 
-from flask import render_template
-from os.path import join
-import csv
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import lru_cache, wraps
+import hashlib
 import logging
+import os
+import threading
+import time
+
+from flask import make_response, request
+
+from app_helper import LRU, TEST_CACHE_SIZE
 
 logger = logging.getLogger(__name__)
 
+TEMPLATES = (
+    "error.html",
+    "result_guess.html",
+    "guess.html",
+    "result_noguess.html",
+    "directory_noguess.html",
+    "directory_guess.html",
+)
+
+DIR_TEMPLATES = {"GUESS": "directory_guess.html", "NOGUESS": "directory_noguess.html"}
+# Seconds browsers/proxies may reuse a directory page without asking again
+DIR_MAX_AGE = 300
+# Seconds before show_dir tries a failed directory build again
+DIR_RETRY_AFTER = 60
+# Seconds between checks for changed report files behind the directory pages
+DIR_CHECK_AFTER = 10
+
+
+class TestRecord:
+    # One row of the directory page
+    __slots__ = ("shots", "names", "date", "result", "varname")
+
+    def __init__(self, shots, names, date, result, varname):
+        self.shots = shots
+        self.names = names
+        self.date = date
+        self.result = result
+        self.varname = varname
+
+
+def cached_page(view):
+    # Decorator for the per-test views: keep the rendered page in memory per
+    # (view, arguments, test version, script root), and send an ETag so a browser that
+    # already has the page gets a 304 instead of the body. The first argument
+    # is always the testname.
+    @wraps(view)
+    def wrapper(self, *args):
+        body, status, etag = self._page(
+            view, args, self.h.test_version(args[0]), request.script_root
+        )
+        response = make_response(body, status)
+        if status == 200:
+            response.set_etag(etag)
+            response = response.make_conditional(request)
+        return response
+
+    return wrapper
+
 
 class AppFunctions:
     def __init__(self, theapp, helper):
         self.app = theapp
         self.h = helper
-
+        # Look the templates up once instead of going through the loader
+        # on every request (which is what render_template does).
+        self._templates = {
+            name: self.app.jinja_env.get_template(name) for name in TEMPLATES
+        }
+        # script root -> {"base_data", "reverse_data", "pages"}; see _dir_cache
+        self._show_dir_base_cache = {}
+        self._ctx_cache = LRU(TEST_CACHE_SIZE)
+        self._shots_cache = LRU(TEST_CACHE_SIZE)
+        self._prewarm_lock = threading.Lock()
+        # time.monotonic() before which a failed build isn't retried
+        self._prewarm_retry_at = 0
+        threading.Thread(target=self._prewarm_in_background, daemon=True).start()
+
+    def _render(self, name, **context):
+        # Same as flask.render_template, but with the cached Template objects.
+        return self._render_ctx(name, context)
+
+    def _render_ctx(self, name, context):
+        # _render for an already built context dict; the dict gets the
+        # context processors' values added to it, so pass a fresh one.
+        template = self._templates[name]
+        # auto_reload is only on in debug mode; pick up edited templates there.
+        if self.app.jinja_env.auto_reload and not template.is_up_to_date:
+            template = self.app.jinja_env.get_template(name)
+            self._templates[name] = template
+        self.app.update_template_context(context)
+        return template.render(context)
+
+    def _error_response(self, batch, why, title, status):
+        return self._error_page(request.script_root, batch, why, title, status)
+
+    @lru_cache(maxsize=256)
+    def _error_page(self, root, batch, why, title, status):
+        # Error pages only depend on these arguments (and, through their
+        # links, on the script root the app is mounted at), so render each
+        # one once
+        return self._render("error.html", batch=batch, why=why, title=title), status
+
+    @lru_cache(maxsize=2048)
+    def _page(self, view, args, version, root):
+        # (body, status, etag) for one rendered view; see cached_page.
+        # root is only part of the key: the page's links depend on it.
+        rv = view(self, *args)
+        body, status = rv if isinstance(rv, tuple) else (rv, 200)
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        return body, status, etag
+
+    @cached_page
     def result_guess(self, testname, batch, guess):
         # Show the result of the guess. Only in guess mode.
         # Used to be called show_winner
         winner_row, dirname = self.h.win_dir(testname)
 
         if winner_row is None:
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why="Incorrect Test Name",
-                    secret=winner_row,
-                ),
-                404,
-            )
+            return self._error_response(batch, "Incorrect Test Name", None, 404)
 
         if not self.h.test_in_batch(testname, batch):
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why="Ordering scheme: " + batch + " not found",
-                    title="Err...",
-                ),
-                404,
+            return self._error_response(
+                batch, "Ordering scheme: " + batch + " not found", "Err...", 404
             )
 
-        stats = self.h.row_stats(winner_row)
-        guessstats = self.h.guess_stats(winner_row, dirname, guess)
-        tables = self.h.get_tables(dirname)
-        diagnostic_charts = self.h.get_diagnostic_charts(dirname)
-        info = self.h.get_info(dirname)
-        graphname = "pamplona.jpeg"
-        force_local_graph = self.h.graph_local(testname, graphname)
-        nexttest = self.h.next_test(testname, batch)
-        prevtest = self.h.prev_test(testname, batch)
-
-        diag = self.h.get_diag_graphs(testname)
-
-        return render_template(
-            "result_guess.html",
-            batch=batch,
-            graphname=graphname,
-            leancorrectly=guessstats["leancorrectly"],
-            guessedcorrectly=guessstats["guessedcorrectly"],
-            isconfidence=guessstats["isconfidence"],
-            win_by=stats["win_by"],
-            atleast=stats["lowerbound"],
-            atmost=stats["upperbound"],
-            winner=guessstats["winner"],
-            loser=guessstats["loser"],
-            testname=testname,
-            nexttest=nexttest,
-            prevtest=prevtest,
-            tables=tables,
-            diagnostic_graphs=diag,
-            diagnostic_charts=diagnostic_charts,
-            description=info,
-            force_local_graph=force_local_graph,
-            dollar_pct=stats["dollar_pct"],
-            lower_dollar=stats["lower_dollar"],
-            upper_dollar=stats["upper_dollar"],
-            campaign=stats["campaign"],
+        ctx = dict(self._build_context(testname, batch))
+        ctx["guessedcorrectly"], ctx["leancorrectly"] = self.h.guess_correctness(
+            winner_row, guess
         )
+        return self._render_ctx("result_guess.html", ctx)
 
+    @cached_page
     def ask_guess(self, testname, batch):
         # Ask the user to guess a winner
         # Only in guess mode
         winner_row, dirname = self.h.win_dir(testname)
         screenshotlines = self.h.screenshot_lines(dirname)
         if screenshotlines["error"]:
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why=screenshotlines["why"],
-                    title="404'd!",
-                ),
-                404,
-            )
-        else:
-            screenshotlines = screenshotlines["lines"]
+            return self._error_response(batch, screenshotlines["why"], "404'd!", 404)
 
-        screenshots, longnames, manytype = self.h.find_screenshots_and_names(
-            dirname, screenshotlines
-        )
-        stats = self.h.row_stats(winner_row)
+        screenshots, longnames, manytype = self._shots_names(dirname)
+        stats = self.h.row_stats_by_test(testname)
         guessnone = self.h.get_guessnone()
         info = self.h.get_info(dirname)
 
-        return render_template(
+        return self._render(
             "guess.html",
             manytype=manytype,
             batch=batch,
@@ -124,81 +171,87 @@ class AppFunctions:
             description=info,
         )
 
+    @cached_page
     def show_noguess(self, testname, batch):
         # Show the stats, screenshots, etc all in the same page
         winner_row, dirname = self.h.win_dir(testname)
         if winner_row is None:
-            return render_template(
-                "error.html", batch=batch, why="Incorrect Test Name", secret=winner_row
-            )
+            return self._error_response(batch, "Incorrect Test Name", None, 200)
 
         if not self.h.test_in_batch(testname, batch):
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why="Ordering scheme: " + batch + " not found",
-                    title="Err...",
-                ),
-                404,
+            return self._error_response(
+                batch, "Ordering scheme: " + batch + " not found", "Err...", 404
             )
 
         screenshotlines = self.h.screenshot_lines(dirname)
         if screenshotlines["error"]:
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why=screenshotlines["why"],
-                    title="404'd!",
-                ),
-                404,
-            )
-        else:
-            screenshotlines = screenshotlines["lines"]
-
-        screenshots, longnames, manytype = self.h.find_screenshots_and_names(
-            dirname, screenshotlines
+            return self._error_response(batch, screenshotlines["why"], "404'd!", 404)
+
+        screenshots, longnames, manytype = self._shots_names(dirname)
+        ctx = dict(self._build_context(testname, batch))
+        ctx["manytype"] = manytype
+        ctx["imgs"] = screenshots
+        ctx["longnames"] = longnames
+        return self._render_ctx("result_noguess.html", ctx)
+
+    def _shots_names(self, dirname, lines=None):
+        # find_screenshots_and_names for a test, cached until its report
+        # changes (screenshots.csv, and val_lookup.csv for the long names),
+        # per script root for the placeholder URL.
+        # Pass lines if they've already been read.
+        key = (
+            dirname,
+            self.h.test_version(os.path.basename(dirname)),
+            request.script_root,
         )
-        stats = self.h.row_stats(winner_row)
-        guessstats = self.h.guess_stats(winner_row, dirname)
-        tables = self.h.get_tables(dirname)
-        diagnostic_charts = self.h.get_diagnostic_charts(dirname)
-        info = self.h.get_info(dirname)
-        graphname = "pamplona.jpeg"
-        force_local_graph = self.h.graph_local(testname, graphname)
-        nexttest = self.h.next_test(testname, batch)
-        prevtest = self.h.prev_test(testname, batch)
 
-        diag = self.h.get_diag_graphs(testname)
+        def find():
+            if lines is None:
+                return self.h.find_screenshots_and_names(
+                    dirname, self.h.load_screenshot_lines(dirname)
+                )
+            return self.h.find_screenshots_and_names(dirname, lines)
 
-        return render_template(
-            "result_noguess.html",
-            batch=batch,
-            graphname=graphname,
-            isconfidence=guessstats["isconfidence"],
-            win_by=stats["win_by"],
-            atleast=stats["lowerbound"],
-            atmost=stats["upperbound"],
-            winner=guessstats["winner"],
-            loser=guessstats["loser"],
-            testname=testname,
-            nexttest=nexttest,
-            prevtest=prevtest,
-            tables=tables,
-            diagnostic_graphs=diag,
-            description=info,
-            diagnostic_charts=diagnostic_charts,
-            force_local_graph=force_local_graph,
-            manytype=manytype,
-            imgs=screenshots,
-            longnames=longnames,
-            dollar_pct=stats["dollar_pct"],
-            lower_dollar=stats["lower_dollar"],
-            upper_dollar=stats["upper_dollar"],
-            campaign=stats["campaign"],
+        return self._shots_cache.get_or_set(key, find)
+
+    def _build_context(self, testname, batch):
+        # The template context result_guess and show_noguess have in common.
+        # Cached until the test's report changes; callers must copy it
+        # before adding their own fields.
+        winner_row, dirname = self.h.win_dir(testname)
+        key = (testname, batch, self.h.test_version(testname))
+        return self._ctx_cache.get_or_set(
+            key, lambda: self._make_context(testname, batch, winner_row, dirname)
         )
 
+    def _make_context(self, testname, batch, winner_row, dirname):
+        stats = self.h.row_stats_by_test(testname)
+        guessstats = self.h.guess_stats(winner_row, dirname)
+        graphname = "pamplona.jpeg"
+        ctx = {
+            "batch": batch,
+            "graphname": graphname,
+            "isconfidence": guessstats["isconfidence"],
+            "win_by": stats["win_by"],
+            "atleast": stats["lowerbound"],
+            "atmost": stats["upperbound"],
+            "winner": guessstats["winner"],
+            "loser": guessstats["loser"],
+            "testname": testname,
+            "nexttest": self.h.next_test(testname, batch),
+            "prevtest": self.h.prev_test(testname, batch),
+            "tables": self.h.get_tables(dirname),
+            "diagnostic_graphs": self.h.get_diag_graphs(testname),
+            "diagnostic_charts": self.h.get_diagnostic_charts(dirname),
+            "description": self.h.get_info(dirname),
+            "force_local_graph": self.h.graph_local(testname, graphname),
+            "dollar_pct": stats["dollar_pct"],
+            "lower_dollar": stats["lower_dollar"],
+            "upper_dollar": stats["upper_dollar"],
+            "campaign": stats["campaign"],
+        }
+        return ctx
+
     def show_dir(self, batch, MODE):
         # show dirname
         # Depending on the mode, do or don't display certain bits.
@@ -206,149 +259,183 @@ class AppFunctions:
         # Only support chronological and reverse for now
         if batch not in ["chronological", "reverse"]:
             logger.error(
-                f"Unsupported batch type: {batch}. Only 'chronological' and 'reverse' are supported."
+                "Unsupported batch type: %s. Only 'chronological' and 'reverse' are supported.",
+                batch,
             )
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why=f"Batch type '{batch}' not supported. Use 'chronological' or 'reverse'.",
-                    title="Unsupported Batch",
-                ),
+            return self._error_response(
+                batch,
+                f"Batch type '{batch}' not supported. Use 'chronological' or 'reverse'.",
+                "Unsupported Batch",
                 400,
             )
 
-        # Check if we have the base processed data cached
-        if (
-            hasattr(self, "_show_dir_base_cache")
-            and "base_data" in self._show_dir_base_cache
-        ):
-            logger.info(f"Using cached base data for {batch}")
-            base_data = self._show_dir_base_cache["base_data"]
-
-            # Reorder the data based on the batch
+        # Normally built by prewarm() at startup, and rebuilt by _dir_cache
+        # once the report files behind it change
+        dir_cache = self._show_dir_base_cache.get(request.script_root)
+        now = time.monotonic()
+        if dir_cache is not None and now < dir_cache["checked"] + DIR_CHECK_AFTER:
+            # Runs on every /dir/ hit: skip even the call when INFO is off
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Using cached base data for %s", batch)
+        else:
+            try:
+                dir_cache = self._dir_cache()
+            except Exception as e:
+                logger.error("Could not build the directory: %s", e)
+                # a failed rebuild keeps serving the pages we have
+                if dir_cache is None:
+                    return self._error_response(
+                        batch, "Error building the directory", "Error", 500
+                    )
+        # Every batch/mode combination is rendered up front
+        page = dir_cache["pages"].get((batch, MODE))
+        if page is None:
+            # Not pre-rendered (unknown mode, or rendering failed)
             if batch == "reverse":
-                # Reverse the order of all the data
-                reordered_data = {
-                    "list": list(reversed(base_data["list"])),
-                    "allshots": {
-                        test: base_data["allshots"][test]
-                        for test in reversed(base_data["list"])
-                    },
-                    "allnames": {
-                        test: base_data["allnames"][test]
-                        for test in reversed(base_data["list"])
-                    },
-                    "alldates": {
-                        test: base_data["alldates"][test]
-                        for test in reversed(base_data["list"])
-                    },
-                    "allresults": {
-                        test: base_data["allresults"][test]
-                        for test in reversed(base_data["list"])
-                    },
-                    "allvarnames": {
-                        test: base_data["allvarnames"][test]
-                        for test in reversed(base_data["list"])
-                    },
-                }
-            else:
-                # Use chronological order (original order)
-                reordered_data = base_data
-
-            # Render template with reordered data
-            if MODE == "NOGUESS":
-                template = "directory_noguess.html"
+                reordered_data = dir_cache["reverse_data"]
             else:
-                template = "directory_guess.html"
-
-            return render_template(template, mode=MODE, batch=batch, **reordered_data)
-
-        # If no base cache, process everything once
-        logger.info(f"Processing base data - this may take a while")
-
-        # Get chronological test list (this is now fast due to caching)
-        showthese = self.h.all_tests("chronological")
-
-        # Process all the expensive data once
-        allshots = {}
-        allnames = {}
-        alldates = {}
-        allresults = {}
-        allvarnames = {}
-
-        for test in showthese:
-            winner_row, dirname = self.h.win_dir(test)
+                reordered_data = dir_cache["base_data"]
             try:
-                with open(join(dirname, "screenshots.csv"), "r") as fin:
-                    reader = csv.reader(fin, delimiter=",")
-                    next(reader)  # Skip header
-                    lines = list(reader)
-                    screenshots, longnames, manytype = (
-                        self.h.find_screenshots_and_names(dirname, lines)
-                    )
-                    allshots[test] = screenshots
-                    allnames[test] = longnames
-                    result = self.h.row_stats(winner_row)
-                    date = result["date"]
-                    alldates[test] = date
-                    allvarnames[test] = result["variable"]
-                    result["winner"] = winner_row["winner"]
-                    result["loser"] = winner_row["loser"]
-                    allresults[test] = result
+                return self._render(
+                    DIR_TEMPLATES.get(MODE, "directory_guess.html"),
+                    mode=MODE,
+                    batch=batch,
+                    **reordered_data,
+                )
             except Exception as e:
-                logger.error(f"Error processing test {test}: {e}")
-                continue
-
-        # Cache the base processed data
-        base_data = {
-            "list": showthese,
-            "allshots": allshots,
-            "allnames": allnames,
-            "alldates": alldates,
-            "allresults": allresults,
-            "allvarnames": allvarnames,
-        }
-
-        if not hasattr(self, "_show_dir_base_cache"):
-            self._show_dir_base_cache = {}
-        self._show_dir_base_cache["base_data"] = base_data
-        logger.info("Cached base data")
-
-        # Now return the appropriate order
-        if batch == "reverse":
-            # Return reverse order
-            reordered_data = {
-                "list": list(reversed(showthese)),
-                "allshots": {test: allshots[test] for test in reversed(showthese)},
-                "allnames": {test: allnames[test] for test in reversed(showthese)},
-                "alldates": {test: alldates[test] for test in reversed(showthese)},
-                "allresults": {test: allresults[test] for test in reversed(showthese)},
-                "allvarnames": {
-                    test: allvarnames[test] for test in reversed(showthese)
-                },
-            }
+                logger.error("Template rendering error: %s", e)
+                return self._error_response(
+                    batch, "Error rendering template", "Error", 500
+                )
+
+        body, etag = page
+        response = make_response(body)
+        response.set_etag(etag)
+        # Behind basic auth only the browser may keep the page; a shared
+        # proxy would hand it out to clients without the password
+        if self.app.config.get("BASIC_AUTH_FORCE") or request.authorization:
+            response.cache_control.private = True
         else:
-            # Return chronological order
-            reordered_data = base_data
+            response.cache_control.public = True
+        response.cache_control.max_age = DIR_MAX_AGE
+        return response.make_conditional(request)
+
+    def prewarm(self):
+        # Build the directory for the app's configured root (test request
+        # contexts use APPLICATION_ROOT), so the first /dir/ request is fast.
+        # Runs in a background thread at startup.
+        with self.app.test_request_context():
+            self._dir_cache()
+
+    def _dir_cache(self):
+        # show_dir's base data and pre-rendered pages for the current
+        # request's script root, built on first use and rebuilt when a
+        # test's report changes. The page links (and the placeholder
+        # screenshot URL) depend on where the app is mounted, so an app
+        # mounted under a prefix gets its own. The lock makes a request wait
+        # for a build in progress.
+        root = request.script_root
+        with self._prewarm_lock:
+            dir_cache = self._show_dir_base_cache.get(root)
+            version = self._dir_version()
+            if dir_cache is not None:
+                dir_cache["checked"] = time.monotonic()
+                if dir_cache["version"] == version:
+                    return dir_cache
+            # Don't redo a failed scan on every /dir/ hit
+            if time.monotonic() < self._prewarm_retry_at:
+                raise RuntimeError("the last build failed, retrying later")
+            self._prewarm_retry_at = time.monotonic() + DIR_RETRY_AFTER
+            logger.info("Processing base data - this may take a while")
+            base_data = self._build_base_data()
+            # The templates walk "list" and index into records, so the
+            # reverse view shares the records and only has a reversed list.
+            reverse_data = dict(base_data, list=list(reversed(base_data["list"])))
+            dir_cache = {
+                "base_data": base_data,
+                "reverse_data": reverse_data,
+                "pages": self._prerender_dirs(base_data, reverse_data),
+                "version": version,
+                "checked": time.monotonic(),
+            }
+            self._show_dir_base_cache[root] = dir_cache
+            logger.info("Cached base data")
+            self._prewarm_retry_at = 0
+        return dir_cache
+
+    def _dir_version(self):
+        # Changes when any listed test's report does (stat calls only)
+        return tuple(
+            self.h.test_version(test) for test in self.h.all_tests("chronological")
+        )
 
-        # Render template
-        if MODE == "NOGUESS":
-            template = "directory_noguess.html"
-        else:
-            template = "directory_guess.html"
+    def _prerender_dirs(self, base_data, reverse_data):
+        # (batch, mode) -> (html, etag) for every directory page
+        pages = {}
+        for batch, data in (("chronological", base_data), ("reverse", reverse_data)):
+            for mode, template in DIR_TEMPLATES.items():
+                try:
+                    body = self._render(template, mode=mode, batch=batch, **data)
+                except Exception as e:
+                    logger.error("Template rendering error: %s", e)
+                    continue
+                etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+                pages[(batch, mode)] = (body, etag)
+        return pages
+
+    def _prewarm_in_background(self):
+        try:
+            self.prewarm()
+        except Exception as e:
+            # Not fatal: the first /dir/ request will try again
+            logger.error("Prewarm failed: %s", e)
 
+    def _build_base_data(self):
+        # Get chronological test list (this is now fast due to caching)
+        showthese = self.h.all_tests("chronological")
+        # and every test's files, read in one pass over the report directory
+        walked = self.h.walk_all_tests()
+
+        # Process all the expensive data once. Each test is independent and
+        # mostly waiting on file/URL I/O, so fan out over a thread pool. Every
+        # task gets its own copy of the current (request) context for url_for.
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    self._process_one_test,
+                    test,
+                    walked.get(test),
+                )
+                for test in showthese
+            ]
+            results = [future.result() for future in futures]
+
+        # Assemble in this thread, in chronological order
+        records = {}
+        for processed in results:
+            if processed is not None:
+                test, record = processed
+                records[test] = record
+
+        return {"list": showthese, "records": records}
+
+    def _process_one_test(self, test, walked):
+        # Everything show_dir needs for one test, or None if it can't be read.
+        # walked is the test's entry from AppHelper.walk_all_tests.
+        if walked is None:
+            logger.error("Error processing test %s: missing report files", test)
+            return None
+        dirname, lines, winner_row = walked
         try:
-            result = render_template(template, mode=MODE, batch=batch, **reordered_data)
-            return result
+            screenshots, longnames, manytype = self._shots_names(dirname, lines)
+            result = dict(self.h.row_stats_by_test(test))
+            result["winner"] = winner_row["winner"]
+            result["loser"] = winner_row["loser"]
         except Exception as e:
-            logger.error(f"Template rendering error: {e}")
-            return (
-                render_template(
-                    "error.html",
-                    batch=batch,
-                    why="Error rendering template",
-                    title="Error",
-                ),
-                500,
-            )
+            logger.error("Error processing test %s: %s", test, e)
+            return None
+        record = TestRecord(
+            screenshots, longnames, result["date"], result, result["variable"]
+        )
+        return test, record
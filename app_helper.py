@@ -1,25 +1,217 @@
 #!/usr/bin/env python3
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import logging
+import os
+import pickle
 from os.path import isfile, join, basename
-from os import walk
-import urllib.request
-import urllib.error
+from os import stat
 from random import choice, shuffle
 from glob import glob
-from time import strftime, gmtime
+from time import strftime, gmtime, monotonic
 import re
+import tempfile
+import threading
+
+from flask import request
 
 # app_helper.py
 # called by app_functions.py and hello.py
 
 GUESSNODIFF = "__guess_no_difference__"
+# Screenshots that were hosted on imgur, now mirrored on S3
+IMGUR_PREFIX = "http://i.imgur.com"
+# On-disk caches that survive a restart (gitignored)
+CACHE_DIR = ".cache"
+SCREENSHOT_CACHE = join(CACHE_DIR, "screenshots.pkl")
+S3_URL_CACHE = join(CACHE_DIR, "s3_urls.pkl")
+# One line per test with its meta.csv mtime and the columns in BATCH_FIELDS
+META_INDEX = join(CACHE_DIR, "meta_index.tsv")
+# Batches that are orderings/filters of the meta.csv files, built together
+# (random, interesting and order files aren't)
+META_BATCHES = frozenset(
+    ("chronological", "reverse", "ascending", "descending", "english", "foreign")
+)
+# Upper bound on memoized per-test results (comfortably above the test count)
+TEST_CACHE_SIZE = 4096
+# The meta.csv columns all_tests orders and filters by
+BATCH_FIELDS = ("time", "bestguess", "language")
+# First line of META_INDEX (a file in another format is ignored)
+META_INDEX_HEADER = "\t".join(("testname", "mtime") + BATCH_FIELDS)
+# Threads for reading many small report files at once
+IO_WORKERS = 32
+# diagnostic_<type>_<n>.jpeg files in a test's report directory
+DIAG_RE = re.compile(r"diagnostic_(?P<type>.*)_[0-9]*\.jpeg$")
+# the same, split into type (None for plain diagnostic_<n>.jpeg) and number
+DIAG_NUM_RE = re.compile(r"diagnostic_(?:(?P<type>.*)_)?(?P<num>[0-9]+)\.jpeg$")
+# Seconds to wait on an existence check for a remote file
+URL_TIMEOUT = 2
+# Seconds before a cached existence check is made again
+URL_CACHE_TTL = 600
+# The results tables in a test's report directory, in the order pages show them
+REPORT_TABLES = ("reportA.html", "reportB.html", "reportD.html", "reportE.html")
+# The files in a test's report directory that its pages are built from
+TEST_FILES = (
+    "meta.csv",
+    "screenshots.csv",
+    "val_lookup.csv",
+    "info.txt",
+    *REPORT_TABLES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _read_text_or_none(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _mtimes(paths):
+    # st_mtime_ns of each path, None for one that doesn't exist
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def _write_atomically(path, data):
+    # Write bytes to a temp file next to path and then swap it in, so a crash
+    # never leaves a half-written file. The temp name is unique, so processes
+    # (e.g. several gunicorn workers) saving at once don't clobber each other.
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def _make_http_session():
+    # One keep-alive connection pool for all the existence checks, instead of
+    # a new TCP+TLS handshake per probe
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Built on first use, so requests is only imported once a page actually has a
+# remote URL to check (never, when developing against local static files)
+_http = None
+_http_lock = threading.Lock()
+
+
+def _http_session():
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                _http = _make_http_session()
+    return _http
+
+
+class LRU:
+    # A bounded cache for hot lookups with tiny values, where the per-entry
+    # bookkeeping of functools.lru_cache would be most of the cost.
+    # None results aren't cached.
+    __slots__ = ("d", "cap")
+
+    def __init__(self, cap):
+        self.d = OrderedDict()
+        self.cap = cap
+
+    def get_or_set(self, key, factory):
+        v = self.d.get(key)
+        if v is not None:
+            try:
+                self.d.move_to_end(key)
+            except KeyError:
+                pass  # evicted by another thread in the meantime
+            return v
+        v = factory()
+        self.d[key] = v
+        if len(self.d) > self.cap:
+            self.d.popitem(last=False)
+        return v
+
+
+def _head_status(url):
+    # HEAD instead of GET: only the status matters, not the body. Returns
+    # (found, when) for a definitive answer, None when the server couldn't say.
+    # (requests' exceptions are all IOErrors)
+    try:
+        status = (
+            _http_session()
+            .head(url, timeout=URL_TIMEOUT, allow_redirects=False)
+            .status_code
+        )
+    except IOError:
+        return None
+    if 200 <= status < 300:
+        return (True, monotonic())
+    if status in (403, 404, 410):
+        return (False, monotonic())
+    # Redirects aren't followed, so a 3xx says nothing about the file itself;
+    # like 5xx it's a miss for now and probed again next time
+    return None
+
+
+# url -> (found, when); only definitive answers, see _head_status
+_head_cache = LRU(4096)
+
+
+def _head_exists(url):
+    # Misses are cached too, since the same candidates get probed over and over,
+    # but every answer is re-checked after URL_CACHE_TTL
+    hit = _head_cache.get_or_set(url, lambda: _head_status(url))
+    if hit is None:
+        return False
+    found, when = hit
+    if monotonic() - when > URL_CACHE_TTL:
+        _head_cache.d.pop(url, None)
+        return _head_exists(url)
+    return found
 
 
 class AppHelper:
     def __init__(self, theapp, s3):
         self.app = theapp
         self.alltests_cache = dict()
-        self.NOSHOT = list()
+        self.alltests_set_cache = dict()
+        self.alltests_index = dict()
+        # (reader, args) -> (mtimes of the files it read, result);
+        # see _cached_by_mtime
+        self._file_cache = dict()
+        self._meta_batches_lock = threading.Lock()
+        # Shared by everything that reads many small files at once
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+        # path -> (mtime_ns, size, lines) for screenshots.csv files
+        self._csv_cache = self._load_pickle(SCREENSHOT_CACHE)
+        self._csv_cache_dirty = False
+        atexit.register(self._save_csv_cache)
+        # (testname, varname, imgur_url) -> url find_screenshots_and_names shows
+        self._s3_url_cache = self._load_pickle(S3_URL_CACHE)
+        self._s3_url_cache_dirty = False
+        atexit.register(self._save_s3_url_cache)
+        # script root -> placeholder image URL; see _noshot_url
+        self._noshot_urls = dict()
         if s3:
             try:
                 import flask_s3
@@ -41,9 +233,18 @@ class AppHelper:
 
     def win_dir(self, testname):
         # Given a testname, return a winner row and a dirname
+        return self._cached_by_mtime(
+            ("win_dir", testname),
+            [join("static", "report", testname, "meta.csv")],
+            lambda: self._win_dir(testname),
+        )
+
+    def test_version(self, testname):
+        # A token that changes whenever a test's report changes: its directory
+        # (files added, removed or replaced) and the files in TEST_FILES
+        # (edited in place). Stat calls only.
         dirname = join("static", "report", testname)
-        winner_row = self._get_row(dirname)
-        return winner_row, dirname
+        return _mtimes([dirname] + [join(dirname, name) for name in TEST_FILES])
 
     def row_stats(self, winner_row):
         d = dict()
@@ -68,6 +269,14 @@ class AppHelper:
         d["date"] = strftime("%a, %d %b %Y %H:%M:%S UTC", date)
         return d
 
+    def row_stats_by_test(self, testname):
+        # row_stats for a test, kept until its meta.csv changes
+        return self._cached_by_mtime(
+            ("row_stats", testname),
+            [join("static", "report", testname, "meta.csv")],
+            lambda: self.row_stats(self.win_dir(testname)[0]),
+        )
+
     def guess_stats(self, winner_row, dirname, guess=None):
         d = dict()
         isconfidence = self._is_confident(winner_row)
@@ -77,72 +286,58 @@ class AppHelper:
         )
         return d
 
+    def guess_correctness(self, winner_row, guess):
+        # Just the (guessedcorrectly, leancorrectly) part of guess_stats
+        isconfidence = self._is_confident(winner_row)
+        return self._judge_guess(winner_row["winner"], isconfidence, guess)
+
     def get_info(self, dirname):
-        infofile = "info.txt"
-        try:
-            with open(join(dirname, infofile), "r") as fin:
-                infotext = fin.read()
-        except FileNotFoundError:
-            # probably no such file
-            infotext = ""
-        return infotext
+        path = join(dirname, "info.txt")
+        # "" if there is probably no such file
+        return self._cached_by_mtime(
+            ("info", dirname), [path], lambda: _read_text_or_none(path) or ""
+        )
 
     def get_tables(self, filename):
-        tables = []
-        report_files = ["reportA.html", "reportB.html", "reportD.html", "reportE.html"]
-
-        try:
-            for report_file in report_files:
-                with open(join(filename, report_file), "r") as f:
-                    tables.append(f.read())
-        except FileNotFoundError:
-            try:
-                with open(filename + "report.html", "r") as f:
-                    tables = f.read()
-            except FileNotFoundError:
-                tables = "notable"
-        return tables
+        paths = [join(filename, table) for table in REPORT_TABLES]
+        return self._cached_by_mtime(
+            ("tables", filename),
+            paths + [filename + "report.html"],
+            lambda: self._read_tables(filename, paths),
+        )
 
     def graph_local(self, testname, graphname):
-        use_local = False
-        file_or_url_name = join("report", testname, graphname)
-        exists, isurl = self._exists_and_is_url(
-            self.url_for("static", filename=file_or_url_name)
+        # The check can go over the network; keep the answer until the test's
+        # directory changes
+        return self._cached_by_mtime(
+            ("graph_local", testname, graphname),
+            [join("static", "report", testname)],
+            lambda: self._graph_local(testname, graphname),
         )
-        # if it's not on the server, fallback to trying local file
-        if not exists and isurl:
-            use_local = True
-        return use_local
 
     def get_diag_graphs(self, testname):
-        diag_types = self._diagnostic_types(testname)
-        diag = {}
-        for diag_type in diag_types:
-            diagnostic_num, use_local_diag = self._max_diagnostic_num(
-                testname, diag_type
-            )
-            diag[diag_type] = {"num": diagnostic_num, "local": use_local_diag}
-        return diag
+        # The probing below is slow (it can go over the network), so keep
+        # the answer until the test's directory changes
+        return self._cached_by_mtime(
+            ("diag_graphs", testname),
+            [join("static", "report", testname)],
+            lambda: self._find_diag_graphs(testname),
+        )
 
     def get_diagnostic_charts(self, directory):
-        # currently this should return nothing:
-        names = glob(directory + "/diagnostic_data*.html")
-        toreturn = []
-        for name in names:
-            try:
-                with open(name, "r") as f:
-                    toreturn.append(f.read())
-            except FileNotFoundError:
-                continue
-        return toreturn
+        # Looked up by name, so kept until the directory changes
+        return self._cached_by_mtime(
+            ("diag_charts", directory),
+            [directory],
+            lambda: self._read_diagnostic_charts(directory),
+        )
 
     def next_test(self, thistest, batch):
         # assume all_tests is already sorted, so we just need to find the next one.
         if not self.test_in_batch(thistest, batch):
             return "wrong batch"
-        alltests = self.all_tests(batch)
-        thisindex = alltests.index(thistest)
-        nextindex = thisindex + 1
+        alltests, index = self._batch_index(batch)
+        nextindex = index[thistest] + 1
         if nextindex < len(alltests):
             next_test = alltests[nextindex]
         else:
@@ -154,27 +349,70 @@ class AppHelper:
         # assume all_tests is already sorted, so we just need to find the next one.
         if not self.test_in_batch(thistest, batch):
             return "wrong batch"
-        alltests = self.all_tests(batch)
-        thisindex = alltests.index(thistest)
-        previndex = thisindex - 1
-        if previndex > 0:
+        alltests, index = self._batch_index(batch)
+        previndex = index[thistest] - 1
+        if previndex >= 0:
             prev = alltests[previndex]
         else:
             return None
         return prev
 
+    def load_screenshot_lines(self, dirname):
+        # The rows of screenshots.csv (without the header).
+        # Parsed once and then reused until the file's mtime or size changes.
+        path = join(dirname, "screenshots.csv")
+        st = stat(path)
+        cached = self._csv_cache.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        # One bulk read, then let the (C) csv parser run over the in-memory
+        # lines rather than pulling them through the text file object.
+        # Unbuffered binary: the file is read in one syscall, with no buffer
+        # or text-wrapper layers in between.
+        with open(path, "rb", buffering=0) as fin:
+            text = fin.read().decode("utf-8")
+        if '"' not in text:
+            # Nothing quoted, so a plain split gives the same fields as csv
+            lines = [line.split(",") for line in text.splitlines()[1:] if line]
+        else:
+            reader = csv.reader(text.splitlines(True), delimiter=",")
+            next(reader)  # Skip header
+            lines = [row for row in reader if row]
+        self._csv_cache[path] = (st.st_mtime_ns, st.st_size, lines)
+        self._csv_cache_dirty = True
+        return lines
+
+    def walk_all_tests(self):
+        # One os.scandir pass over static/report, reading each test's
+        # meta.csv and screenshots.csv as we go (both through their caches).
+        # Returns {testname: (dirname, screenshot lines, winner_row)} for every
+        # test that has both files.
+        found = {}
+        with os.scandir(join("static", "report")) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                # a directory with a missing, empty or unparseable meta.csv
+                # or screenshots.csv is just left out
+                try:
+                    winner_row, dirname = self.win_dir(entry.name)
+                    if winner_row is None:
+                        continue
+                    lines = self.load_screenshot_lines(dirname)
+                except (OSError, StopIteration, csv.Error, UnicodeDecodeError):
+                    continue
+                found[entry.name] = (dirname, lines, winner_row)
+        return found
+
     def screenshot_lines(self, dirname):
         try:
-            with open(join(dirname, "screenshots.csv"), "r") as fin:
-                reader = csv.reader(fin, delimiter=",")
-                next(reader)  # Skip header
-                lines = list(reader)
+            lines = self.load_screenshot_lines(dirname)
         except FileNotFoundError:
             return dict(error=True, why="No such test: " + dirname)
 
         # so "lines" = lines in screenshots.csv
 
-        if len(set(list(zip(*lines))[1])) != 2:
+        if len({line[1] for line in lines}) != 2:
             # if there are not 2 variations
             return dict(error=True, why="Wrong number of screenshots: " + dirname)
 
@@ -187,220 +425,68 @@ class AppHelper:
         manytype = "multivariate"
         # remember, 'line' = line in screenshots.csv
 
+        lookup = self._load_val_lookup(dirname)
+        # Get testname from the directory
+        testname = basename(dirname)
+        # Convert imgur URLs to S3 URLs with fallback logic
+        # (non-imgur URLs are left unchanged)
+        s3_urls = self._s3_screenshot_urls(
+            testname,
+            {(line[1], line[3]) for line in lines if line[3].startswith(IMGUR_PREFIX)},
+        )
+
         for line in lines:
             varname = line[1]
-            desc = self._real_value(varname, dirname)
-            longnames[varname] = desc  # No need for decode in Python 3
+            longnames[varname] = self._real_value(varname, lookup)
             thisshot = line[3]
-
-            # Get testname from the directory
-            testname = basename(dirname)
-
-            # Convert imgur URLs to S3 URLs with fallback logic
-            if thisshot != "NA" and thisshot.startswith("http://i.imgur.com"):
-                thisshot = self._get_s3_screenshot_url(thisshot, testname, varname)
-            elif thisshot != "NA" and not thisshot.startswith("http://i.imgur.com"):
-                # Non-imgur URLs should be left unchanged
-                pass
-
-            if line[1] in screenshots:
-                if thisshot != "NA":
-                    if thisshot not in screenshots[varname]:
-                        screenshots[varname].append(thisshot)
-                    if line[4] != "NA":
-                        manytype = "combo"
-                        extra_shot = line[4]
-                        # Convert extra screenshot URLs too
-                        if extra_shot.startswith("http://i.imgur.com"):
-                            extra_shot = self._get_s3_imgur_fallback_url(extra_shot)
-                        if extra_shot not in screenshots[varname]:
-                            screenshots[varname].append(extra_shot)
-                    # screenshots[varname] = list(set(screenshots[varname]))
-            else:
-                if thisshot != "NA":
-                    screenshots[varname] = [thisshot]
-                    if line[4] != "NA":
-                        manytype = "combo"
-                        extra_shot = line[4]
-                        # Convert extra screenshot URLs too
-                        if extra_shot.startswith("http://i.imgur.com"):
-                            extra_shot = self._get_s3_imgur_fallback_url(extra_shot)
-                        screenshots[varname].append(extra_shot)
-                else:
-                    # screenshot missing
-                    screenshots[varname] = []
-
-        self.NOSHOT = self._get_or_set_noshot_url()
-        for val in screenshots:
-            if screenshots[val] == []:
-                screenshots[val].append(self.NOSHOT)
+            if thisshot.startswith(IMGUR_PREFIX):
+                thisshot = s3_urls[(varname, thisshot)]
+
+            # The keys are an ordered set of this variation's screenshots
+            shots = screenshots.setdefault(varname, {})
+            if thisshot != "NA":
+                shots[thisshot] = None
+                if line[4] != "NA":
+                    manytype = "combo"
+                    extra_shot = line[4]
+                    # Convert extra screenshot URLs too
+                    if extra_shot.startswith(IMGUR_PREFIX):
+                        extra_shot = self._get_s3_imgur_fallback_url(extra_shot)
+                    shots[extra_shot] = None
+
+        # variations whose screenshot is missing get the placeholder
+        noshot = self._noshot_url()
+        screenshots = {
+            val: list(shots) or [noshot] for val, shots in screenshots.items()
+        }
 
         return screenshots, longnames, manytype
 
     def all_tests(self, batch):
-        # Only cache chronological data once
-        if "chronological" not in self.alltests_cache:
-            # Process the base chronological data once
-            import logging
-            from concurrent.futures import ThreadPoolExecutor
-            import threading
-
-            logger = logging.getLogger(__name__)
-            logger.info(
-                f"Building chronological data - will be used for both chronological and reverse"
-            )
-
-            # Process test directories in parallel for much better performance
-            logger.info("Starting parallel processing of test directories...")
-            time_dict = {}
-
-            try:
-                # Use glob instead of walk to avoid potential hanging issues
-                import os
-
-                logger.info("Getting test directories with glob...")
-                test_dirs = glob(join("static", "report", "*"))
-                logger.info(f"Glob returned {len(test_dirs)} items")
-                test_list = [d.split("/")[-1] for d in test_dirs if os.path.isdir(d)]
-                logger.info(f"Found {len(test_list)} test directories to process")
-            except Exception as e:
-                logger.error(f"Error getting test list: {e}")
-                return []
-
-            def process_single_test(testname):
-                try:
-                    m = join("static", "report", testname, "meta.csv")
-                    with open(m, "r") as fin:
-                        reader = csv.DictReader(fin)
-                        r = next(reader)
-                        time = int(r["time"])
-                        return time, testname
-                except Exception as e:
-                    logger.debug(f"Error processing test {testname}: {e}")
-                    return None
-
-            # Process tests in parallel with ThreadPoolExecutor
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                futures = [
-                    executor.submit(process_single_test, testname)
-                    for testname in test_list
-                ]
-
-                # Collect all results first, then process them in order
-                results = []
-                completed = 0
-                for future in futures:
-                    try:
-                        result = future.result(timeout=5)  # 5 second timeout per test
-                        if result:
-                            results.append(result)
-                        completed += 1
-                        if completed % 50 == 0:
-                            logger.info(
-                                f"Processed {completed}/{len(test_list)} test directories"
-                            )
-                    except Exception as e:
-                        logger.error(f"Error in parallel processing: {e}")
-                        completed += 1
-
-                # Now process results in chronological order
-                logger.info("Sorting results chronologically...")
-                results.sort(key=lambda x: x[0])  # Sort by timestamp
-
-                # Build time_dict with proper ordering
-                for time, testname in results:
-                    # Handle time collisions
-                    while time in time_dict and time_dict[time] != testname:
-                        time += 1
-                    time_dict[time] = testname
-
-            logger.info(
-                f"Successfully processed {len(time_dict)} tests with valid meta.csv files"
-            )
-            if len(time_dict) == 0:
-                logger.error("No tests were processed successfully")
-                return []
-
-            logger.info("Building chronological batch...")
-            sorted_timekey_list = sorted(time_dict)
-            self.alltests_cache["chronological"] = []
-            for time in sorted_timekey_list:
-                self.alltests_cache["chronological"].append(time_dict[time])
-            logger.info(
-                f"Built chronological batch with {len(self.alltests_cache['chronological'])} tests"
-            )
+        # chronological/reverse, ascending/descending and english/foreign
+        # all come out of one pass over the meta.csv files, so build them
+        # together, once
+        if self._needs_meta_batches(batch):
+            # Request threads can get here together on a cold start; only
+            # one of them scans (and writes the index), the rest wait for it
+            with self._meta_batches_lock:
+                if self._needs_meta_batches(batch):
+                    batches = self._build_meta_batches()
+                    if not batches:
+                        return []
+                    self.alltests_cache.update(batches)
 
         # Now return the appropriate batch
-        if batch == "chronological":
-            return self.alltests_cache["chronological"]
-        elif batch == "reverse":
-            # Just return chronological data in reverse order
-            return list(reversed(self.alltests_cache["chronological"]))
+        if batch in META_BATCHES:
+            return self.alltests_cache[batch]
         else:
-            # Handle other batch types (random, ascending, descending, etc.)
+            # Handle other batch types (random, interesting, order files)
             if batch == "random" and batch not in self.alltests_cache:
-                test_list = next(walk(join("static", "report")))[1]
+                with os.scandir(join("static", "report")) as it:
+                    test_list = [entry.name for entry in it if entry.is_dir()]
                 shuffle(test_list)
                 self.alltests_cache[batch] = test_list
 
-            elif (
-                batch in ["ascending", "descending"]
-                and batch not in self.alltests_cache
-            ):
-                metas = glob(join("static", "report", "*", "meta.csv"))
-                tests = dict()
-                final_list = []
-
-                for m in metas:
-                    try:
-                        with open(m, "r") as fin:
-                            testname = m[14:-9]
-                            # after static/report/ and before meta.csv"
-                            reader = csv.DictReader(fin)
-                            r = next(reader)
-                            guess = float(r["bestguess"])
-                            inserted_yet = False
-                            while not inserted_yet:
-                                if guess in tests and tests[guess] != testname:
-                                    guess += 0.001
-                                else:
-                                    tests[guess] = testname
-                                    inserted_yet = True
-                    except FileNotFoundError:
-                        continue
-
-                sorted_tests = sorted(tests)
-                for guess in sorted_tests:
-                    final_list.append(tests[guess])
-
-                ascending = final_list[:]
-                final_list.reverse()
-                descending = final_list[:]
-                self.alltests_cache["descending"] = descending
-                self.alltests_cache["ascending"] = ascending
-
-            elif batch in ["english", "foreign"] and batch not in self.alltests_cache:
-                english_test_list = []
-                foreign_gibberish = []
-                chron = self.all_tests("chronological")
-
-                for testname in chron:
-                    m = join("static", "report", testname, "meta.csv")
-                    try:
-                        with open(m, "r") as fin:
-                            reader = csv.DictReader(fin)
-                            r = next(reader)
-                            lang = r["language"].lower()
-                            if lang == "yy" or lang == "en":
-                                english_test_list.append(testname)
-                            else:
-                                foreign_gibberish.append(testname)
-                    except FileNotFoundError:
-                        pass
-
-                self.alltests_cache["english"] = english_test_list
-                self.alltests_cache["foreign"] = foreign_gibberish
-
             elif batch == "interesting" and batch not in self.alltests_cache:
                 # Get interesting tests from config instead of hardcoded list
                 try:
@@ -409,13 +495,14 @@ class AppHelper:
                     # Fallback if config is not available
                     interesting_tests = []
 
-                # Filter to only include tests that actually exist
-                existing_tests = []
-                for test in interesting_tests:
-                    if self.test_in_batch(test, "chronological"):
-                        existing_tests.append(test)
-
-                self.alltests_cache["interesting"] = existing_tests
+                # Filter to only include tests that actually exist, keeping
+                # the configured order
+                existing = self.alltests_set_cache.get("chronological")
+                if existing is None:
+                    existing = frozenset(self.alltests_cache["chronological"])
+                self.alltests_cache["interesting"] = [
+                    test for test in interesting_tests if test in existing
+                ]
 
             elif batch not in self.alltests_cache:
                 try:
@@ -428,9 +515,6 @@ class AppHelper:
                     self.alltests_cache[batch] = test_list
                 except FileNotFoundError:
                     # Log the error and provide a more descriptive message
-                    import logging
-
-                    logger = logging.getLogger(__name__)
                     logger.warning(
                         f"Batch order file not found for '{batch}': {filename}"
                     )
@@ -444,10 +528,17 @@ class AppHelper:
             return []
 
     def test_in_batch(self, thistest, batch):
-        alltests = self.all_tests(batch)
-        if thistest not in alltests:
-            return False
-        return True
+        # Called on every request, so check against a set, not the list.
+        # "reverse" has the same tests as "chronological".
+        key = "chronological" if batch == "reverse" else batch
+        members = self.alltests_set_cache.get(key)
+        if members is None:
+            alltests = self.all_tests(key)
+            members = frozenset(alltests)
+            if key in self.alltests_cache:
+                # only remember it once the batch itself is cached
+                self.alltests_set_cache[key] = members
+        return thistest in members
 
     #############
     #############
@@ -516,6 +607,23 @@ class AppHelper:
 
     # PRIVATE:
 
+    def _batch_index(self, batch):
+        # (all_tests(batch), {testname: position in it}) for next/prev_test,
+        # remembered once the batch itself is cached
+        cached = self.alltests_index.get(batch)
+        if cached is not None:
+            return cached
+        alltests = self.all_tests(batch)
+        cached = (alltests, {t: i for i, t in enumerate(alltests)})
+        if batch in self.alltests_cache:
+            self.alltests_index[batch] = cached
+        return cached
+
+    def _win_dir(self, testname):
+        dirname = join("static", "report", testname)
+        winner_row = self._get_row(dirname)
+        return winner_row, dirname
+
     def _is_confident(self, winrow):
         lowbound = winrow["lowerbound"]
         if float(lowbound) < 0:  # if there is no clear winner
@@ -524,16 +632,126 @@ class AppHelper:
 
     def _get_row(self, dirname):
         try:
-            with open(join(dirname, "meta.csv"), "r") as fin:
-                reader = csv.DictReader(fin, delimiter=",")
-                row_dict = next(reader)  # skip header
-                return row_dict
+            return self._read_meta(dirname)
         except FileNotFoundError:
             return None
 
+    def _needs_meta_batches(self, batch):
+        return "chronological" not in self.alltests_cache or (
+            batch in META_BATCHES and batch not in self.alltests_cache
+        )
+
+    def _scan_all_meta(self):
+        # [(testname, meta.csv row)] for every test directory with a meta.csv,
+        # with just the columns the batches are built from.
+        # Rows come from the one-file META_INDEX while their meta.csv keeps
+        # the mtime recorded there; new or changed ones are read again and
+        # the index rewritten.
+        index = self._load_meta_index()
+        with os.scandir(join("static", "report")) as it:
+            testnames = [entry.name for entry in it if entry.is_dir()]
+        mtimes = _mtimes([join("static", "report", t, "meta.csv") for t in testnames])
+        found = {}
+        todo = []
+        for testname, mtime in zip(testnames, mtimes):
+            if mtime is None:
+                continue  # no meta.csv (yet)
+            cached = index.get(testname)
+            if cached is not None and cached[0] == mtime:
+                found[testname] = cached
+            else:
+                todo.append((testname, mtime))
+        if todo:
+            logger.info(
+                "Reading meta.csv for %d of %d tests", len(todo), len(testnames)
+            )
+            metas = self._read_metas([t for t, _ in todo], BATCH_FIELDS)
+            for (testname, mtime), r in zip(todo, metas):
+                if r is not None:
+                    found[testname] = (mtime, r)
+        if found.keys() != index.keys():
+            self._save_meta_index(found)
+        return [(t, found[t][1]) for t in testnames if t in found]
+
+    def _build_meta_batches(self):
+        # The batches that are orderings/filters of the meta.csv fields.
+        # Returns {} if no test could be placed chronologically.
+        logger.info("Building the chronological, ascending and language batches")
+        # time -> tests started then, bestguess -> tests;
+        # ties are ordered by name
+        by_time = {}
+        by_guess = {}
+        language = {}
+        for testname, r in self._scan_all_meta():
+            language[testname] = r.get("language", "").lower()
+            try:
+                by_time.setdefault(int(r["time"]), []).append(testname)
+            except (KeyError, ValueError) as e:
+                logger.debug("No usable time for test %s: %s", testname, e)
+            try:
+                by_guess.setdefault(float(r["bestguess"]), []).append(testname)
+            except (KeyError, ValueError) as e:
+                logger.debug("No usable bestguess for test %s: %s", testname, e)
+
+        if len(by_time) == 0:
+            logger.error("No tests were processed successfully")
+            return {}
+
+        chronological = [t for k in sorted(by_time) for t in sorted(by_time[k])]
+        ascending = [t for k in sorted(by_guess) for t in sorted(by_guess[k])]
+        english = [t for t in chronological if language[t] in ("yy", "en")]
+        foreign = [t for t in chronological if language[t] not in ("yy", "en")]
+        logger.info("Built chronological batch with %d tests", len(chronological))
+        return {
+            "chronological": chronological,
+            "reverse": chronological[::-1],
+            "ascending": ascending,
+            "descending": ascending[::-1],
+            "english": english,
+            "foreign": foreign,
+        }
+
+    def _read_metas(self, testnames, fields=None):
+        # _read_meta for many tests at once, None where there is no meta.csv.
+        # A plain loop: the files are tiny and usually in the page cache, so
+        # handing them to threads costs more than the reads themselves.
+        metas = []
+        for testname in testnames:
+            try:
+                meta = self._read_meta(join("static", "report", testname), fields)
+            except (OSError, StopIteration, csv.Error) as e:
+                logger.debug("Could not read meta.csv for %s: %s", testname, e)
+                meta = None
+            metas.append(meta)
+        return metas
+
+    def _read_meta(self, dirname, fields=None):
+        return self._first_row(join(dirname, "meta.csv"), fields)
+
+    def _first_row(self, path, fields=None):
+        # {column: value} for the first row under the header of a small csv
+        # file, keeping only the columns in fields (if given). Zips the
+        # header with that row instead of going through csv.DictReader;
+        # meta.csv quotes every field, so it still needs csv for the parsing.
+        with open(path, "r", newline="") as fin:
+            reader = csv.reader(fin)
+            header = next(reader)
+            row = next(reader)
+        if fields is None:
+            return dict(zip(header, row))
+        return {h: v for h, v in zip(header, row) if h in fields}
+
     def _true_results(self, winrow, dirname, isconfidence, guess=None):
         winner = winrow["winner"]
         loser = winrow["loser"]
+        guessedcorrectly, leancorrectly = self._judge_guess(winner, isconfidence, guess)
+
+        lookup = self._load_val_lookup(dirname)
+        winner = self._real_value(winner, lookup)
+        loser = self._real_value(loser, lookup)
+        return guessedcorrectly, leancorrectly, winner, loser
+
+    def _judge_guess(self, winner, isconfidence, guess):
         guessedcorrectly = False
         leancorrectly = False
         if guess is not None:
@@ -548,115 +766,170 @@ class AppHelper:
         else:
             guessedcorrectly = None
             leancorrectly = None
-
-        winner = self._real_value(winner, dirname)  # No need for decode in Python 3
-        loser = self._real_value(loser, dirname)  # No need for decode in Python 3
-        return guessedcorrectly, leancorrectly, winner, loser
-
-    def _is_url(self, f_or_url):
-        isurl = False
-        if f_or_url[0:4] == "http":
-            isurl = True
-        return isurl
+        return guessedcorrectly, leancorrectly
 
     def _exists_url(self, file_or_url):
-        # print "does" + file_or_url + "exist?"
-        try:
-            with urllib.request.urlopen(urllib.request.Request(file_or_url)) as f:
-                # print ('yes')
-                return True
-        except (urllib.error.URLError, urllib.error.HTTPError):
-            # print('no')
-            return False
+        return _head_exists(file_or_url)
 
     def _exists_file(self, file_or_url):
-        try:
-            with open(
-                file_or_url[1:]
-            ):  # because of the weird way self.url_for works (it prefixes a forward slash to "static/...")
-                return True
-        except IOError:
-            return False
+        # because of the weird way self.url_for works (it prefixes a forward slash to "static/...")
+        return isfile(file_or_url.removeprefix("/"))
 
     def _exists_and_is_url(self, file_or_url):
         # Given a url or file, try to fetch that item, and return if it exists or not
-        is_a_url = self._is_url(file_or_url)
-
-        if is_a_url:
+        if file_or_url.startswith("http"):
             return self._exists_url(file_or_url), True
         else:
             return self._exists_file(file_or_url), False
 
-    def _max_diagnostic_num(self, testname, diag_type):
-        # returns the maximum X on the files called "diagnostic[X].jpeg"
+    def _max_diagnostic_num(self, testname, diag_type, local_max=0):
+        # returns (n, use_local) where files "diagnostic[X].jpeg" exist for
+        # X in 1..n-1 (the templates loop over range(1, n)),
         # assuming that there is no gap
         # return 0 if none exist
-        STARTCHECK = 10
         MAXNUM = 30
-        # start at i = STARTCHECK. See if there's a plot of the name diagnostic<i>.jpeg existing.
-        #   If not, decrement i until it does. (Stop below 1)
-        #   If so, increment i until it doesn't (Stop at MAXNUM)
-        # return i
-        i = STARTCHECK
-        direction = "start"
-        use_local = False
-        while i > 0 and i < MAXNUM:
-            if diag_type != "":
-                filename = "_".join(["diagnostic", diag_type, str(i)])
-            else:
-                filename = "_".join(["diagnostic", str(i)])
-            file_or_url_name = join("report", testname, filename + ".jpeg")
-            exists, isurl = self._exists_and_is_url(
-                self.url_for("static", filename=file_or_url_name)
-            )
-            # if it's not on the server, fallback to trying local file
-            if isurl and not exists:
-                # print ('isurl and not exists')
-                # print ('isurl = '+ str(isurl))
-                # print ('exists = '+ str(exists))
-                exists, isurl = self._exists_and_is_url(
-                    join("/static", file_or_url_name)
-                )
-                if exists:
-                    use_local = True
-                # the slash is needed to mimic the bad behavior of self.url_for
-
-            if exists:
-                # print(file_or_url_name)
-                if direction == "decrement":
-                    # print "returning " + str(i) + ","+str(use_local)
-                    return i, use_local
-                else:
-                    i = i + 1
-                    direction = "increment"
-            else:
-                if direction == "increment":
-                    # print "returning " + str(i) + ","+str(use_local)
-                    return i, use_local
-                else:
-                    i = i - 1
-                    direction = "decrement"
-        # print "returning " + str(i) + ","+str(use_local)
-        return i, False
-
-    def _real_value(self, value_slug, dirname):
-        # given a short value, and the dirname (static/report/testname), look up the long description
+        if local_max:
+            # The directory listing already says how many there are; only
+            # check whether the last one has to be served locally.
+            num = min(local_max, MAXNUM - 1)
+            return num + 1, self._diagnostic_exists(testname, diag_type, num)[1]
+
+        names = [
+            self._diagnostic_path(testname, diag_type, i) for i in range(1, MAXNUM)
+        ]
+        urls = [self.url_for("static", filename=name) for name in names]
+        if not urls[0].startswith("http"):
+            # served from the directory we just listed, which has none
+            return 0, False
+        # Otherwise they can only be on the remote host. Ask about every
+        # candidate at once rather than one round trip after another.
+        found = list(self._io_pool.map(_head_exists, urls))
+        num = found.index(False) if False in found else len(found)
+        if num == 0:
+            return 0, False
+        return num + 1, False
+
+    def _diagnostic_path(self, testname, diag_type, i):
+        # path of diagnostic plot number i under static/
+        if diag_type != "":
+            filename = "_".join(["diagnostic", diag_type, str(i)])
+        else:
+            filename = "_".join(["diagnostic", str(i)])
+        return join("report", testname, filename + ".jpeg")
+
+    def _diagnostic_exists(self, testname, diag_type, i):
+        # (exists, use_local) for diagnostic plot number i
+        file_or_url_name = self._diagnostic_path(testname, diag_type, i)
+        exists, isurl = self._exists_and_is_url(
+            self.url_for("static", filename=file_or_url_name)
+        )
+        # if it's not on the server, fallback to trying local file
+        if isurl and not exists:
+            # the slash is needed to mimic the bad behavior of self.url_for
+            exists, isurl = self._exists_and_is_url(join("/static", file_or_url_name))
+            return exists, exists
+        return exists, False
+
+    def _real_value(self, value_slug, lookup):
+        # given a short value, and the test's _load_val_lookup, return the long description
+        # (or the short value itself if it isn't listed)
+        if lookup is None:
+            return value_slug
+        return lookup.get(value_slug, value_slug)
+
+    def _load_val_lookup(self, dirname):
+        # short value -> long description, from static/report/testname/val_lookup.csv
+        # None if the test has no such file. Parsed once per mtime of the file.
+        path = join(dirname, "val_lookup.csv")
+        return self._cached_by_mtime(
+            ("val_lookup", dirname), [path], lambda: self._read_val_lookup(path)
+        )
+
+    def _read_val_lookup(self, path):
         try:
-            with open(join(dirname, "val_lookup.csv"), "r") as fin:
+            with open(path, "r") as fin:
                 reader = csv.reader(fin, delimiter=",")
                 next(reader)  # skip header
-                lookup = dict(reader)
-                return lookup[value_slug]
+                return dict(reader)
         except FileNotFoundError:
-            return value_slug
+            return None
+
+    def _read_tables(self, filename, paths):
+        # read the four tables side by side rather than one after another
+        tables = list(self._io_pool.map(_read_text_or_none, paths))
+        if any(table is not None for table in tables):
+            # a missing one just leaves its slot empty; the templates index
+            # into these by position
+            tables = ["" if table is None else table for table in tables]
+        else:
+            try:
+                with open(filename + "report.html", "r") as f:
+                    tables = f.read()
+            except FileNotFoundError:
+                tables = "notable"
+        return tables
+
+    def _graph_local(self, testname, graphname):
+        use_local = False
+        file_or_url_name = join("report", testname, graphname)
+        exists, isurl = self._exists_and_is_url(
+            self.url_for("static", filename=file_or_url_name)
+        )
+        # if it's not on the server, fallback to trying local file
+        if not exists and isurl:
+            use_local = True
+        return use_local
+
+    def _read_diagnostic_charts(self, directory):
+        # currently this should return nothing:
+        names = glob(directory + "/diagnostic_data*.html")
+        toreturn = []
+        for name in names:
+            try:
+                with open(name, "r") as f:
+                    toreturn.append(f.read())
+            except FileNotFoundError:
+                continue
+        return toreturn
 
-    def _get_or_set_noshot_url(self):
-        if not self.NOSHOT:
-            self.NOSHOT = self.url_for("static", filename="img/noshot.gif")
-            # exists, isurl = exists_and_is_url(self.NOSHOT)
-            # if(not exists):
-            # 	self.NOSHOT = local_self.url_for('static', filename='img/noshot.gif')
-        return self.NOSHOT
+    def _noshot_url(self):
+        # The placeholder image for variations without a screenshot. Its URL
+        # depends on where the app is mounted, so it is looked up once per
+        # script root, in the first request that needs it.
+        root = request.script_root
+        url = self._noshot_urls.get(root)
+        if url is None:
+            url = self.url_for("static", filename="img/noshot.gif")
+            self._noshot_urls[root] = url
+        return url
+
+    def _cached_by_mtime(self, key, paths, compute):
+        # compute(), remembered under key until the mtime of any of paths
+        # changes (or one appears or disappears). The one invalidation rule
+        # for everything read from a test's report files.
+        mtimes = _mtimes(paths)
+        cached = self._file_cache.get(key)
+        if cached is not None and cached[0] == mtimes:
+            return cached[1]
+        value = compute()
+        self._file_cache[key] = (mtimes, value)
+        return value
+
+    def _s3_screenshot_urls(self, testname, shots):
+        # {(varname, imgur_url): url to show} for a test's imgur screenshots.
+        # Each pick can take two HEAD requests, so the ones we haven't seen
+        # before are worked out side by side rather than one after another.
+        keys = [(testname, varname, imgur_url) for varname, imgur_url in shots]
+        todo = [key for key in keys if key not in self._s3_url_cache]
+        if todo:
+            picks = self._io_pool.map(
+                lambda key: self._get_s3_screenshot_url(key[2], key[0], key[1]), todo
+            )
+            for key, url in zip(todo, picks):
+                self._s3_url_cache[key] = url
+                if url != key[2]:
+                    self._s3_url_cache_dirty = True
+        return {key[1:]: self._s3_url_cache[key] for key in keys}
 
     def _get_s3_screenshot_url(self, imgur_url, testname, value):
         """
@@ -697,11 +970,8 @@ class AppHelper:
         Check if an S3 URL exists by making a HEAD request
         """
         try:
-            import urllib.request
-
-            req = urllib.request.Request(url, method="HEAD")
-            with urllib.request.urlopen(req, timeout=5) as response:
-                return response.status == 200
+            response = _http_session().head(url, timeout=5, allow_redirects=False)
+            return response.status_code == 200
         except Exception:
             return False
 
@@ -726,17 +996,98 @@ class AppHelper:
             # Fallback to original imgur URL
             return imgur_url
 
-    def _diagnostic_types(self, testname):
-        type_re = r"diagnostic_(?P<type>.*)_[0-9]*\.jpeg$"
-        files = next(walk(join("static", "report", testname)))[2]
+    def _load_pickle(self, path):
+        # Returns {} if there is no usable cache file
+        try:
+            with open(path, "rb") as fin:
+                return pickle.load(fin)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Ignoring unreadable cache %s: %s", path, e)
+            return {}
+
+    def _save_pickle(self, path, obj):
+        try:
+            _write_atomically(path, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        except OSError as e:
+            logger.warning("Could not write cache %s: %s", path, e)
+
+    def _load_meta_index(self):
+        # {testname: (meta.csv mtime_ns, row)} from META_INDEX; {} if it is
+        # missing or in another format
+        try:
+            with open(META_INDEX, "r", encoding="utf-8") as fin:
+                lines = fin.read().split("\n")
+        except FileNotFoundError:
+            return {}
+        if lines[0] != META_INDEX_HEADER:
+            return {}
+        index = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            testname, mtime, *values = line.split("\t")
+            index[testname] = (int(mtime), dict(zip(BATCH_FIELDS, values)))
+        return index
+
+    def _save_meta_index(self, index):
+        # A header line, then testname<TAB>mtime<TAB>time<TAB>bestguess<TAB>language
+        # per test
+        lines = [META_INDEX_HEADER]
+        for testname, (mtime, r) in index.items():
+            values = [testname, str(mtime)] + [r.get(f, "") for f in BATCH_FIELDS]
+            lines.append("\t".join(values))
+        try:
+            _write_atomically(META_INDEX, ("\n".join(lines) + "\n").encode("utf-8"))
+        except OSError as e:
+            logger.warning("Could not write cache %s: %s", META_INDEX, e)
+
+    def _save_csv_cache(self):
+        if self._csv_cache_dirty:
+            self._save_pickle(SCREENSHOT_CACHE, dict(self._csv_cache))
+            self._csv_cache_dirty = False
+
+    def _find_diag_graphs(self, testname):
+        with os.scandir(join("static", "report", testname)) as it:
+            files = [entry.name for entry in it if entry.is_file()]
+        diag_types = self._diagnostic_types(files)
+        # the highest plot number of each type that is in the directory
+        local_max = {}
+        for filename in files:
+            matches = DIAG_NUM_RE.match(filename)
+            if matches:
+                diagtype = matches.group("type") or ""
+                num = int(matches.group("num"))
+                local_max[diagtype] = max(local_max.get(diagtype, 0), num)
+        diag = {}
+        for diag_type in diag_types:
+            diagnostic_num, use_local_diag = self._max_diagnostic_num(
+                testname, diag_type, local_max.get(diag_type, 0)
+            )
+            diag[diag_type] = {"num": diagnostic_num, "local": use_local_diag}
+        return diag
+
+    def _save_s3_url_cache(self):
+        # Only the URLs that were found on S3 are kept for the next process;
+        # an imgur fallback may just mean S3 couldn't be reached this time.
+        if self._s3_url_cache_dirty:
+            found = {
+                key: url for key, url in self._s3_url_cache.items() if url != key[2]
+            }
+            self._save_pickle(S3_URL_CACHE, found)
+            self._s3_url_cache_dirty = False
+
+    def _diagnostic_types(self, files):
+        # the diagnostic plot types among a test's files ("" is the plain kind)
         alltypes = [""]
         for filename in files:
-            matches = re.match(type_re, filename)
+            matches = DIAG_RE.match(filename)
             if matches:
                 diagtype = matches.group("type")
                 alltypes.append(diagtype)
-        alltypes = list(set(alltypes))
-        return alltypes
+        # dedupe, keeping the order they were found in
+        return list(dict.fromkeys(alltypes))
 
     #############
     #############
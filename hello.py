@@ -107,6 +107,25 @@ def is_s3():
 h = app_helper.AppHelper(app, s3)
 f = app_functions.AppFunctions(app, h)
 
+# The views for MODE, picked once here rather than on every request
+# (None if the mode doesn't exist)
+show_view = {"GUESS": f.ask_guess, "NOGUESS": f.show_noguess}.get(MODE)
+result_view = {
+    "GUESS": f.result_guess,
+    "NOGUESS": lambda testname, batch, guess: f.show_noguess(testname, batch),
+}.get(MODE)
+
+
+def unknown_mode():
+    return (
+        render_template(
+            "error.html",
+            why="Sorry, but mode " + MODE + " doesn't exist.",
+            title="404'd!",
+        ),
+        404,
+    )
+
 
 ### The real stuff
 
@@ -123,14 +142,7 @@ def go_dir(batch):
     if MODE in MODES:
         return f.show_dir(batch, MODE)
     else:
-        return (
-            render_template(
-                "error.html",
-                why="Sorry, but mode " + MODE + " doesn't exist.",
-                title="404'd!",
-            ),
-            404,
-        )
+        return unknown_mode()
 
 
 @app.errorhandler(404)
@@ -182,19 +194,9 @@ def go_test(batch, testname):
             404,
         )
 
-    if MODE == "GUESS":
-        return f.ask_guess(testname, batch)
-    elif MODE == "NOGUESS":
-        return f.show_noguess(testname, batch)
-    else:
-        return (
-            render_template(
-                "error.html",
-                why="Sorry, but mode " + MODE + " doesn't exist.",
-                title="404'd!",
-            ),
-            404,
-        )
+    if show_view is None:
+        return unknown_mode()
+    return show_view(testname, batch)
 
 
 @app.route("/show/<batch>/<testname>/result/<path:guess>")
@@ -211,19 +213,9 @@ def go_result(batch, testname, guess):
             404,
         )
 
-    if MODE == "GUESS":
-        return f.result_guess(testname, batch, guess)
-    elif MODE == "NOGUESS":
-        return f.show_noguess(testname, batch)
-    else:
-        return (
-            render_template(
-                "error.html",
-                why="Sorry, but mode " + MODE + " doesn't exist.",
-                title="404'd!",
-            ),
-            404,
-        )
+    if result_view is None:
+        return unknown_mode()
+    return result_view(testname, batch, guess)
 
 
 if __name__ == "__main__":